@@ -0,0 +1,131 @@
+"""Pod spec parts shared by the ceph-csi-nodeplugin and ceph-csi-provisioner charms.
+
+This is a vendored module, not a published Charmhub library, so it sits
+directly in lib/ rather than under the charms/<name>/v<N>/ library layout.
+Both charms carry an identical copy of it; change them together, and
+tests/test_pod_spec.py in each charm fails if they drift apart.
+"""
+
+import os
+
+DRIVER_NAME = "cephfs.csi.ceph.com"
+CSI_SOCKET_CONTAINER = "/csi/csi.sock"
+CSI_SOCKET_HOST = f"/var/lib/kubelet/plugins/{DRIVER_NAME}/csi.sock"
+CSI_ENDPOINT = f"unix://{CSI_SOCKET_CONTAINER}"
+
+# Arguments shared by several containers.
+CSI_ADDRESS_ARG = f"--csi-address={CSI_SOCKET_CONTAINER}"
+ENDPOINT_ARG = f"--endpoint={CSI_ENDPOINT}"
+
+# Shared by every container that talks to the CSI socket.
+SOCKET_DIR_VOLUME = {
+    "name": "socket-dir",
+    "mountPath": os.path.dirname(CSI_SOCKET_CONTAINER),
+    "hostPath": {
+        "path": os.path.dirname(CSI_SOCKET_HOST),
+        "type": "DirectoryOrCreate",
+    },
+}
+
+# Host paths mounted into the csi-cephfsplugin container, alongside the
+# CSI socket directory.  Shared constants use tuples so they cannot be
+# mutated by accident; ops dumps them as plain YAML sequences.
+PLUGIN_VOLUMES = (
+    {
+        "name": "mountpoint-dir",
+        "mountPath": "/var/lib/kubelet/pods",
+        "hostPath": {"path": "/var/lib/kubelet/pods", "type": "DirectoryOrCreate"},
+    },
+    {
+        "name": "plugin-dir",
+        "mountPath": "/var/lib/kubelet/plugins",
+        "hostPath": {"path": "/var/lib/kubelet/plugins", "type": "Directory"},
+    },
+    {"name": "host-sys", "mountPath": "/sys", "hostPath": {"path": "/sys"}},
+    {
+        "name": "lib-modules",
+        "mountPath": "/lib/modules",
+        "hostPath": {"path": "/lib/modules"},
+    },
+    {"name": "host-dev", "mountPath": "/dev", "hostPath": {"path": "/dev"}},
+    {
+        "name": "host-mount",
+        "mountPath": "/run/mount",
+        "hostPath": {"path": "/run/mount"},
+    },
+    {
+        "name": "keys-tmp-dir",
+        "mountPath": "/tmp/csi/keys",
+        "hostPath": {"path": "/tmp/csi/keys"},
+    },
+    {
+        "name": "ceph-csi-config",
+        "mountPath": "/etc/ceph-csi-config",
+        "hostPath": {"path": "/etc/ceph-csi-config"},
+    },
+)
+
+DEFAULT_ENVIRONMENT = {
+    "NODE_ID": {"field": {"path": "spec.nodeName", "api-version": "v1"}},
+    "POD_IP": {"field": {"path": "status.podIP", "api-version": "v1"}},
+    "CSI_ENDPOINT": CSI_ENDPOINT,
+}
+
+
+def plugin_container(image_details, server_arg, *extra_args):
+    """
+    The csi-cephfsplugin container, serving the node or controller side of
+    the driver depending on `server_arg`.
+    """
+    return {
+        "name": "csi-cephfsplugin",
+        "imageDetails": image_details,
+        "args": [
+            "--nodeid=$(NODE_ID)",
+            "--type=cephfs",
+            server_arg,
+            ENDPOINT_ARG,
+            "--v=5",
+            f"--drivername={DRIVER_NAME}",
+            *extra_args,
+        ],
+        "volumeConfig": (SOCKET_DIR_VOLUME, *PLUGIN_VOLUMES),
+        "envConfig": DEFAULT_ENVIRONMENT,
+        "kubernetes": {"securityContext": {"privileged": True}},
+    }
+
+
+def liveness_container(image_details, metrics_port):
+    """
+    The liveness-prometheus container, probing the CSI socket and serving
+    the result on `metrics_port`.
+    """
+    return {
+        "name": "liveness-prometheus",
+        "imageDetails": image_details,
+        "args": [
+            "--type=liveness",
+            ENDPOINT_ARG,
+            f"--metricsport={metrics_port}",
+            "--metricspath=/metrics",
+            "--polltime=60s",
+            "--timeout=3s",
+        ],
+        "ports": [{"name": "metrics", "containerPort": metrics_port}],
+        "volumeConfig": (SOCKET_DIR_VOLUME,),
+        "envConfig": DEFAULT_ENVIRONMENT,
+    }
+
+
+def validate_pod_spec(spec):
+    """
+    Catch a pod spec that juju would accept but whose containers could never
+    start, before it is sent.  Only the fields filled in from charm config
+    are checked; the fixed arguments are covered by the unit tests.  Raises
+    ValueError describing the first problem found.
+    """
+    for container in spec["containers"]:
+        name = container["name"]
+        for port in container.get("ports", ()):
+            if not 1 <= port["containerPort"] <= 65535:
+                raise ValueError(f"{name} port {port['containerPort']} out of range")
@@ -1,253 +1,185 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
 import logging
 import os
-import socket
 
 from ops.charm import CharmBase
 from ops.main import main
 from ops.framework import StoredState
-from ops.model import ActiveStatus, MaintenanceStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from oci_image import OCIImageResource, OCIImageResourceError
+from ceph_csi_pod_spec import (
+    CSI_ADDRESS_ARG,
+    DEFAULT_ENVIRONMENT,
+    DRIVER_NAME,
+    SOCKET_DIR_VOLUME,
+    liveness_container,
+    plugin_container,
+    validate_pod_spec,
+)
 
 log = logging.getLogger(__name__)
 
+REG_SOCKET_CONTAINER = f"/registration/{DRIVER_NAME}-reg.sock"
+REG_SOCKET_HOST = f"/var/lib/kubelet/plugins_registry/{DRIVER_NAME}-reg.sock"
+
+REGISTRATION_DIR_VOLUME = {
+    "name": "registration-dir",
+    "mountPath": os.path.dirname(REG_SOCKET_CONTAINER),
+    "hostPath": {
+        "path": os.path.dirname(REG_SOCKET_HOST),
+        "type": "DirectoryOrCreate",
+    },
+}
+
+# The charm's own sidecar, less what is only known at hook time: the image
+# details and the metrics port.  The plugin and liveness containers come
+# from the vendored ceph_csi_pod_spec module.
+REGISTRAR_CONTAINER = {
+    "name": "ceph-registrar",
+    "args": (
+        "--v=5",
+        CSI_ADDRESS_ARG,
+        f"--kubelet-registration-path={REG_SOCKET_HOST}",
+    ),
+    "volumeConfig": (SOCKET_DIR_VOLUME, REGISTRATION_DIR_VOLUME),
+    "envConfig": DEFAULT_ENVIRONMENT,
+    "kubernetes": {"securityContext": {"privileged": True}},
+}
+
+K8S_RESOURCES = {
+    "kubernetesResources": {
+        "serviceAccounts": (
+            {
+                "name": "cephfs-csi-nodeplugin",
+                "roles": (
+                    {
+                        "name": "cephfs-csi-nodeplugin",
+                        "global": True,
+                        "rules": (
+                            {
+                                "apiGroups": ("",),
+                                "resources": ("nodes",),
+                                "verbs": ("get",),
+                            },
+                        ),
+                    },
+                ),
+            },
+        )
+    }
+}
+
 
 class CephCsiCharm(CharmBase):
     _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        self._stored.set_default(last_spec_hash=None, last_image_error=None)
 
         self.csi_image = OCIImageResource(self, "csi-image")
         self.registrar_image = OCIImageResource(self, "registrar-image")
 
-        self.framework.observe(self.on.install, self.set_pod_spec)
+        self.framework.observe(self.on.upgrade_charm, self._invalidate_caches)
         self.framework.observe(self.on.upgrade_charm, self.set_pod_spec)
         self.framework.observe(self.on.config_changed, self.set_pod_spec)
+        self.framework.observe(self.on.leader_elected, self._forget_applied_spec)
+        self.framework.observe(self.on.leader_elected, self.set_pod_spec)
+
+    def _invalidate_caches(self, event):
+        """
+        Attaching a new resource revision triggers upgrade-charm, so forget
+        the spec rendered from the previous revision's image details.  The
+        new charm revision may also render a different pod spec from the
+        same inputs.
+        """
+        self._stored.last_spec_hash = None
+
+    def _forget_applied_spec(self, event):
+        """
+        Another unit may have set the pod spec while this one was not the
+        leader, so a newly elected leader sets it again.
+        """
+        self._stored.last_spec_hash = None
+
+    @staticmethod
+    def _hash_inputs(*inputs):
+        """
+        Stable fingerprint of the inputs the pod spec is rendered from.
+        """
+        return hashlib.blake2b(
+            json.dumps(inputs, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
+
+    def _fetch_images(self, *resources):
+        """
+        Fetch the image details of OCI image resources, one at a time since
+        ops' Model.resources is not thread-safe.  They hold the registry
+        credentials, so they are not kept in stored state; hooks whose
+        inputs are unchanged skip the fetch altogether.
+        """
+        return [resource.fetch() for resource in resources]
+
+    def _log_image_error(self, error):
+        """
+        A missing resource fails every hook until it is attached, so only log
+        an image error at ERROR level the first time it is seen.
+        """
+        message = error.status.message
+        if message == self._stored.last_image_error:
+            log.debug(message)
+            return
+        log.error(message)
+        self._stored.last_image_error = message
 
     def set_pod_spec(self, event):
+        # Only the leader may set the pod spec; the other units have nothing
+        # to do.
+        if not self.unit.is_leader():
+            self.model.unit.status = ActiveStatus()
+            return
+
+        # Image resources only change with upgrade-charm, which clears the
+        # stored hash, so unchanged inputs need no image fetch at all.
+        metrics_port = self.model.config["metrics-port"]
+        spec_hash = self._hash_inputs(metrics_port, DRIVER_NAME)
+        # A unit left in any other status by an earlier hook reconciles again.
+        if spec_hash == self._stored.last_spec_hash and isinstance(
+            self.model.unit.status, ActiveStatus
+        ):
+            return
+
         try:
-            csi_image = self.csi_image.fetch()
-            registrar_image = self.registrar_image.fetch()
+            csi_image, registrar_image = self._fetch_images(
+                self.csi_image, self.registrar_image
+            )
         except OCIImageResourceError as e:
             self.model.unit.status = e.status
-            log.error(e)
+            self._log_image_error(e)
             return
+        self._stored.last_image_error = None
 
-        driver_name = "cephfs.csi.ceph.com"
-
-        csi_socket = {
-            "container": "/csi/csi.sock",
-            "host": "/var/lib/kubelet/plugins{}/csi.sock".format(driver_name),
-        }
-        registration_socket = {
-            "container": "/registration/{}-reg.sock".format(driver_name),
-            "host": "/var/lib/kubelet/plugins_registry/{}-reg.sock".format(driver_name),
-        }
-
-        default_environment = {
-            "NODE_ID": {"field": {"path": "spec.nodeName", "api-version": "v1"}},
-            "POD_IP": {"field": {"path": "status.podIP", "api-version": "v1"}},
-            "CSI_ENDPOINT": "unix://{}".format(csi_socket.get("container")),
+        spec = {
+            "version": 3,
+            "containers": [
+                {**REGISTRAR_CONTAINER, "imageDetails": registrar_image},
+                plugin_container(csi_image, "--nodeserver=true"),
+                liveness_container(csi_image, metrics_port),
+            ],
         }
+        try:
+            validate_pod_spec(spec)
+        except ValueError as e:
+            log.error("Invalid pod spec: %s", e)
+            self.model.unit.status = BlockedStatus(f"Invalid pod spec: {e}")
+            return
 
         self.model.unit.status = MaintenanceStatus("Setting pod spec")
-        self.model.pod.set_spec(
-            {
-                "version": 3,
-                "containers": [
-                    {
-                        "name": "ceph-registrar",
-                        "imageDetails": registrar_image,
-                        "args": [
-                            "--v=5",
-                            "--csi-address={}".format(csi_socket.get("container")),
-                            "--kubelet-registration-path={}".format(
-                                registration_socket.get("host")
-                            ),
-                        ],
-                        "ports": [
-                            {
-                                "name": "metrics",
-                                "containerPort": int(self.model.config["metrics-port"]),
-                            }
-                        ],
-                        "volumeConfig": [
-                            {
-                                "name": "socket-dir",
-                                "mountPath": os.path.dirname(
-                                    str(csi_socket.get("container"))
-                                ),
-                                "hostPath": {
-                                    "path": os.path.dirname(
-                                        str(csi_socket.get("host"))
-                                    ),
-                                    "type": "DirectoryOrCreate",
-                                },
-                            },
-                            {
-                                "name": "registration-dir",
-                                "mountPath": os.path.dirname(
-                                    str(registration_socket.get("container"))
-                                ),
-                                "hostPath": {
-                                    "path": os.path.dirname(
-                                        str(registration_socket.get("host"))
-                                    ),
-                                    "type": "DirectoryOrCreate",
-                                },
-                            },
-                        ],
-                        "envConfig": default_environment,
-                        "kubernetes": {
-                            "securityContext": {
-                                "privileged": True,
-                            }
-                        },
-                    },
-                    {
-                        "name": "csi-cephfsplugin",
-                        "imageDetails": csi_image,
-                        "args": [
-                            "--nodeid={}".format(socket.gethostname()),
-                            "--type=cephfs",
-                            "--nodeserver=true",
-                            "--endpoint=unix://{}".format(csi_socket.get("container")),
-                            "--v=5",
-                            "--drivername={}".format(driver_name),
-                        ],
-                        "volumeConfig": [
-                            {
-                                "name": "socket-dir",
-                                "mountPath": os.path.dirname(
-                                    str(csi_socket.get("container"))
-                                ),
-                                "hostPath": {
-                                    "path": os.path.dirname(
-                                        str(csi_socket.get("host"))
-                                    ),
-                                    "type": "DirectoryOrCreate",
-                                },
-                            },
-                            {
-                                "name": "mountpoint-dir",
-                                "mountPath": "/var/lib/kubelet/pods",
-                                "hostPath": {
-                                    "path": "/var/lib/kubelet/pods",
-                                    "type": "DirectoryOrCreate",
-                                },
-                            },
-                            {
-                                "name": "plugin-dir",
-                                "mountPath": "/var/lib/kubelet/plugins",
-                                "hostPath": {
-                                    "path": "/var/lib/kubelet/plugins",
-                                    "type": "Directory",
-                                },
-                            },
-                            {
-                                "name": "host-sys",
-                                "mountPath": "/sys",
-                                "hostPath": {"path": "/sys"},
-                            },
-                            {
-                                "name": "lib-modules",
-                                "mountPath": "/lib/modules",
-                                "hostPath": {"path": "/lib/modules"},
-                            },
-                            {
-                                "name": "host-dev",
-                                "mountPath": "/dev",
-                                "hostPath": {"path": "/dev"},
-                            },
-                            {
-                                "name": "host-mount",
-                                "mountPath": "/run/mount",
-                                "hostPath": {"path": "/run/mount"},
-                            },
-                            {
-                                "name": "keys-tmp-dir",
-                                "mountPath": "/tmp/csi/keys",
-                                "hostPath": {"path": "/tmp/csi/keys"},
-                            },
-                            {
-                                "name": "ceph-csi-config",
-                                "mountPath": "/etc/ceph-csi-config",
-                                "hostPath": {"path": "/etc/ceph-csi-config"},
-                            },
-                        ],
-                        "envConfig": default_environment,
-                        "kubernetes": {
-                            "securityContext": {
-                                "privileged": True,
-                            }
-                        },
-                    },
-                    {
-                        "name": "liveness-prometheus",
-                        "imageDetails": csi_image,
-                        "args": [
-                            "--type=liveness",
-                            "--endpoint=unix://{}".format(csi_socket.get("container")),
-                            "--metricsport={}".format(
-                                self.model.config.get("metrics-port")
-                            ),
-                            "--metricspath=/metrics",
-                            "--polltime=60s",
-                            "--timeout=3s",
-                        ],
-                        "volumeConfig": [
-                            {
-                                "name": "socket-dir",
-                                "mountPath": os.path.dirname(
-                                    str(csi_socket.get("container"))
-                                ),
-                                "hostPath": {
-                                    "path": os.path.dirname(
-                                        str(csi_socket.get("host"))
-                                    ),
-                                    "type": "DirectoryOrCreate",
-                                },
-                            }
-                        ],
-                        "envConfig": {
-                            "NODE_ID": {
-                                "field": {"path": "spec.nodeName", "api-version": "v1"}
-                            },
-                            "POD_IP": {
-                                "field": {"path": "status.podIP", "api-version": "v1"}
-                            },
-                            "CSI_ENDPOINT": "unix://{}".format(
-                                csi_socket.get("container")
-                            ),
-                        },
-                    },
-                ],
-            },
-            k8s_resources={
-                "kubernetesResources": {
-                    "serviceAccounts": [
-                        {
-                            "name": "cephfs-csi-nodeplugin",
-                            "roles": [
-                                {
-                                    "name": "cephfs-csi-nodeplugin",
-                                    "global": True,
-                                    "rules": [
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": ["nodes"],
-                                            "verbs": ["get"],
-                                        }
-                                    ],
-                                }
-                            ],
-                        }
-                    ]
-                }
-            },
-        )
+        self.model.pod.set_spec(spec, k8s_resources=K8S_RESOURCES)
+        self._stored.last_spec_hash = spec_hash
         self.model.unit.status = ActiveStatus()
 
 
@@ -1,14 +1,27 @@
 # Copyright 2021 Joseph David Borg
 # See LICENSE file for licensing details.
 
+import json
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from ops.testing import Harness
 from charm import CephCsiCharm
 
 
 class TestCharm(unittest.TestCase):
+    def _leader_harness(self):
+        """
+        A started leader harness with all of its OCI image resources.
+        """
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.populate_oci_resources()
+        harness.begin()
+        return harness
+
     def test_config_changed(self):
         harness = Harness(CephCsiCharm)
         self.addCleanup(harness.cleanup)
@@ -33,3 +46,130 @@ class TestCharm(unittest.TestCase):
         harness.charm._on_fortune_action(action_event)
 
         self.assertEqual(action_event.fail.call_args, [("fail this",)])
+
+    def test_registry_credentials_not_stored(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        self.assertIsNotNone(harness.get_pod_spec())
+        stored = json.dumps(harness.charm._stored._data.snapshot())
+        self.assertNotIn("password", stored)
+
+    def test_unchanged_pod_spec_not_reapplied(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        self.assertIsNotNone(harness.get_pod_spec())
+        with patch.object(harness.charm.model.pod, "set_spec") as set_spec:
+            harness.charm.set_pod_spec(None)
+            set_spec.assert_not_called()
+            harness.update_config({"metrics-port": 9000})
+            set_spec.assert_called_once()
+
+    def test_image_fetch_error(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.add_oci_resource("csi-image")
+        harness.begin()
+        harness.charm.set_pod_spec(None)
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+        self.assertEqual(
+            harness.charm.unit.status.message, "Missing resource: registrar-image"
+        )
+
+    def test_repeated_image_error_logged_once(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        with self.assertLogs("charm", level="DEBUG") as logs:
+            harness.charm.set_pod_spec(None)
+            harness.charm.set_pod_spec(None)
+        self.assertEqual(
+            [record.levelname for record in logs.records], ["ERROR", "DEBUG"]
+        )
+
+    def test_socket_dir_host_path(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        spec, _ = harness.get_pod_spec()
+        for container in spec["containers"]:
+            volume = container["volumeConfig"][0]
+            self.assertEqual(volume["name"], "socket-dir")
+            self.assertEqual(
+                volume["hostPath"]["path"],
+                "/var/lib/kubelet/plugins/cephfs.csi.ceph.com",
+            )
+
+    def test_unchanged_inputs_skip_image_fetch(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        with patch.object(
+            CephCsiCharm, "_fetch_images", return_value=[{}, {}]
+        ) as fetch_images:
+            harness.charm.set_pod_spec(None)
+            fetch_images.assert_not_called()
+            harness.charm._invalidate_caches(None)
+            harness.charm.set_pod_spec(None)
+            fetch_images.assert_called_once()
+
+    def test_unchanged_pod_spec_reapplied_when_not_active(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        harness.charm.unit.status = MaintenanceStatus("Setting pod spec")
+        with patch.object(harness.charm.model.pod, "set_spec") as set_spec:
+            harness.charm.set_pod_spec(None)
+            set_spec.assert_called_once()
+        self.assertIsInstance(harness.charm.unit.status, ActiveStatus)
+
+    def test_container_args_well_formed(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        spec, _ = harness.get_pod_spec()
+        for container in spec["containers"]:
+            flags = [arg.partition("=")[0] for arg in container["args"]]
+            for flag in flags:
+                self.assertRegex(flag, r"^--[a-z]+(-[a-z]+)*$")
+            self.assertEqual(len(flags), len(set(flags)), container["name"])
+
+    def test_metrics_port_on_liveness_container(self):
+        harness = self._leader_harness()
+        harness.update_config({"metrics-port": 9000})
+        harness.charm.set_pod_spec(None)
+        spec, _ = harness.get_pod_spec()
+        ports = {c["name"]: c.get("ports") for c in spec["containers"]}
+        self.assertEqual(
+            ports,
+            {
+                "ceph-registrar": None,
+                "csi-cephfsplugin": None,
+                "liveness-prometheus": [{"name": "metrics", "containerPort": 9000}],
+            },
+        )
+
+    def test_invalid_metrics_port_blocks(self):
+        harness = self._leader_harness()
+        with patch.object(harness.charm.model.pod, "set_spec") as set_spec:
+            harness.update_config({"metrics-port": 70000})
+            set_spec.assert_not_called()
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+        self.assertEqual(
+            harness.charm.unit.status.message,
+            "Invalid pod spec: liveness-prometheus port 70000 out of range",
+        )
+
+    def test_non_leader_does_not_set_spec(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.populate_oci_resources()
+        harness.begin()
+        harness.update_config({"metrics-port": 9000})
+        self.assertIsNone(harness.get_pod_spec())
+        self.assertIsInstance(harness.charm.unit.status, ActiveStatus)
+
+    def test_leader_elected_sets_spec_again(self):
+        harness = self._leader_harness()
+        harness.charm.set_pod_spec(None)
+        with patch.object(harness.charm.model.pod, "set_spec") as set_spec:
+            harness.set_leader(False)
+            harness.set_leader(True)
+            set_spec.assert_called_once()
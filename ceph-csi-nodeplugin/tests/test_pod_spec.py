@@ -0,0 +1,19 @@
+# Copyright 2021 Joseph David Borg
+# See LICENSE file for licensing details.
+
+import hashlib
+import unittest
+from pathlib import Path
+
+import ceph_csi_pod_spec
+
+
+class TestPodSpec(unittest.TestCase):
+    def test_matches_provisioner_copy(self):
+        ours = Path(ceph_csi_pod_spec.__file__)
+        theirs = Path(__file__).parents[2] / "ceph-csi-provisioner" / "lib" / ours.name
+        self.assertEqual(
+            hashlib.sha256(ours.read_bytes()).hexdigest(),
+            hashlib.sha256(theirs.read_bytes()).hexdigest(),
+            f"{ours} and {theirs} differ; change both copies together",
+        )
@@ -1,30 +1,183 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
-import kubernetes
 import logging
 import os
-import socket
 
 from pathlib import Path
 from ops.charm import CharmBase
 from ops.main import main
 from ops.framework import StoredState
-from ops.model import ActiveStatus, MaintenanceStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from oci_image import OCIImageResource, OCIImageResourceError
+from ceph_csi_pod_spec import (
+    CSI_ADDRESS_ARG,
+    DEFAULT_ENVIRONMENT,
+    DRIVER_NAME,
+    SOCKET_DIR_VOLUME,
+    liveness_container,
+    plugin_container,
+    validate_pod_spec,
+)
 
 log = logging.getLogger(__name__)
 
+# Sidecar arguments besides the CSI socket address, which every sidecar
+# takes first.
+PROVISIONER_ARGS = (
+    "--v=5",
+    "--timeout=150s",
+    "--leader-election=true",
+    "--retry-interval-start=500ms",
+    "--feature-gates=Topology=false",
+    "--extra-create-metadata=true",
+)
+RESIZER_ARGS = (
+    "--v=5",
+    "--timeout=150s",
+    "--leader-election=true",
+    "--retry-interval-start=500ms",
+    "--handle-volume-inuse-error=false",
+)
+SNAPSHOTTER_ARGS = (
+    "--v=5",
+    "--timeout=150s",
+    "--leader-election=true",
+)
+ATTACHER_ARGS = (
+    "--v=5",
+    "--leader-election=true",
+    "--retry-interval-start=500ms",
+)
+
+# The charm's own sidecars, less what is only known at hook time: the image
+# details and the metrics port.  The plugin and liveness containers come
+# from the vendored ceph_csi_pod_spec module.
+PROVISIONER_CONTAINER = {
+    "name": "ceph-provisioner",
+    "args": (CSI_ADDRESS_ARG, *PROVISIONER_ARGS),
+    "volumeConfig": (SOCKET_DIR_VOLUME,),
+}
+RESIZER_CONTAINER = {
+    "name": "ceph-resizer",
+    "args": (CSI_ADDRESS_ARG, *RESIZER_ARGS),
+    "volumeConfig": (SOCKET_DIR_VOLUME,),
+    "envConfig": DEFAULT_ENVIRONMENT,
+}
+SNAPSHOTTER_CONTAINER = {
+    "name": "ceph-snapshotter",
+    "args": (CSI_ADDRESS_ARG, *SNAPSHOTTER_ARGS),
+    "volumeConfig": (SOCKET_DIR_VOLUME,),
+    "kubernetes": {"securityContext": {"privileged": True}},
+}
+ATTACHER_CONTAINER = {
+    "name": "csi-cephfsplugin-attacher",
+    "args": (CSI_ADDRESS_ARG, *ATTACHER_ARGS),
+    "volumeConfig": (SOCKET_DIR_VOLUME,),
+    "envConfig": DEFAULT_ENVIRONMENT,
+}
+
+# Cluster access needed by the provisioner, resizer, snapshotter and
+# attacher sidecars.
+RBAC_RULES = (
+    {"apiGroups": ("",), "resources": ("nodes",), "verbs": ("get", "list", "watch")},
+    {"apiGroups": ("",), "resources": ("secrets",), "verbs": ("get", "list")},
+    {
+        "apiGroups": ("",),
+        "resources": ("events",),
+        "verbs": ("list", "watch", "create", "update", "patch"),
+    },
+    {
+        "apiGroups": ("",),
+        "resources": ("persistentvolumes",),
+        "verbs": ("get", "list", "watch", "create", "delete", "patch"),
+    },
+    {
+        "apiGroups": ("",),
+        "resources": ("persistentvolumeclaims",),
+        "verbs": ("get", "list", "watch", "update"),
+    },
+    {
+        "apiGroups": ("storage.k8s.io",),
+        "resources": ("storageclasses",),
+        "verbs": ("get", "list", "watch"),
+    },
+    {
+        "apiGroups": ("snapshot.storage.k8s.io",),
+        "resources": ("volumesnapshots",),
+        "verbs": ("get", "list"),
+    },
+    {
+        "apiGroups": ("snapshot.storage.k8s.io",),
+        "resources": ("volumesnapshotcontents",),
+        "verbs": ("create", "get", "list", "watch", "update", "delete"),
+    },
+    {
+        "apiGroups": ("snapshot.storage.k8s.io",),
+        "resources": ("volumesnapshotclasses",),
+        "verbs": ("get", "list", "watch"),
+    },
+    {
+        "apiGroups": ("storage.k8s.io",),
+        "resources": ("volumeattachments",),
+        "verbs": ("get", "list", "watch", "update", "patch"),
+    },
+    {
+        "apiGroups": ("storage.k8s.io",),
+        "resources": ("volumeattachments/status",),
+        "verbs": ("patch",),
+    },
+    {
+        "apiGroups": ("",),
+        "resources": ("persistentvolumeclaims/status",),
+        "verbs": ("update", "patch"),
+    },
+    {
+        "apiGroups": ("storage.k8s.io",),
+        "resources": ("csinodes",),
+        "verbs": ("get", "list", "watch"),
+    },
+    {
+        "apiGroups": ("snapshot.storage.k8s.io",),
+        "resources": ("volumesnapshotcontents/status",),
+        "verbs": ("update",),
+    },
+)
+
+# Only the secret and config map in the Kubernetes resources depend on the
+# ceph relation; the service account and its RBAC rules are fixed.
+SERVICE_ACCOUNTS = (
+    {
+        "name": "cephfs-csi-provisioner",
+        "roles": (
+            {
+                "name": "cephfs-csi-provisioner-runner",
+                "global": True,
+                "rules": RBAC_RULES,
+            },
+        ),
+    },
+)
+
 
 class CephCsiCharm(CharmBase):
     _stored = StoredState()
+    _storage_api = None
 
     def __init__(self, *args):
         super().__init__(*args)
+        self._stored.set_default(
+            last_spec_hash=None,
+            last_spec_digest=None,
+            last_image_error=None,
+        )
 
-        self.framework.observe(self.on.install, self.set_pod_spec)
+        self.framework.observe(self.on.upgrade_charm, self._invalidate_caches)
         self.framework.observe(self.on.upgrade_charm, self.set_pod_spec)
         self.framework.observe(self.on.config_changed, self.set_pod_spec)
+        self.framework.observe(self.on.leader_elected, self._forget_applied_spec)
+        self.framework.observe(self.on.leader_elected, self.set_pod_spec)
         self.framework.observe(self.on["ceph"].relation_changed, self.set_pod_spec)
 
         self.csi_image = OCIImageResource(self, "csi-image")
@@ -33,8 +186,6 @@ class CephCsiCharm(CharmBase):
         self.snapshotter_image = OCIImageResource(self, "snapshotter-image")
         self.attacher_image = OCIImageResource(self, "attacher-image")
 
-        self.driver_name = "cephfs.csi.ceph.com"
-
     @staticmethod
     def _get_kubernetes_environment():
         """
@@ -42,429 +193,325 @@ class CephCsiCharm(CharmBase):
         """
         cluster_env = {}
         for e in Path("/proc/1/environ").read_text().split("\x00"):
-            if "KUBERNETES_SERVICE" in e:
-                key, value = e.split("=")
+            key, _, value = e.partition("=")
+            if key.startswith("KUBERNETES_SERVICE"):
                 cluster_env[key] = value
 
         os.environ.update(cluster_env)
 
+    @classmethod
+    def _get_storage_api(cls):
+        """
+        Build the Kubernetes storage API client once and reuse it, so that
+        StorageClass calls share one connection pool to the apiserver.
+        """
+        if cls._storage_api is None:
+            # The client takes a fraction of a second to import, which only
+            # hooks that touch the StorageClass should pay for.
+            import kubernetes
+
+            cls._get_kubernetes_environment()
+
+            configuration = kubernetes.client.Configuration()
+            kubernetes.config.load_incluster_config(client_configuration=configuration)
+            # Pin the pool size rather than relying on the client's default,
+            # which has varied between releases.
+            configuration.connection_pool_maxsize = (os.cpu_count() or 1) * 5
+            cls._storage_api = kubernetes.client.StorageV1Api(
+                kubernetes.client.ApiClient(configuration)
+            )
+        return cls._storage_api
+
     def apply_storage_class(self):
         """
         Currently, v3 Juju pod spec does not support StorageClass.  We'll
-        have to deploy it directly via the Kubernetes API.
+        have to deploy it directly via the Kubernetes API.  Server-side apply
+        makes this idempotent, so an unchanged StorageClass is left in place.
         """
-        self._get_kubernetes_environment()
-
-        configuration = kubernetes.config.load_incluster_config()
-        with kubernetes.client.ApiClient(configuration) as api_client:
-            api_instance = kubernetes.client.StorageV1beta1Api(api_client)
-            sc = {
-                "provisioner": self.driver_name,
-                "reclaim_policy": self.model.config.get("reclaim-policy"),
-                "allow_volume_expansion": self.model.config.get(
-                    "allow-volume-expansion"
-                ),
-                "mount_options": self.model.config.get("mount-options").split(","),
-                "parameters": {
-                    "clusterID": self.model.config.get("cluster-id"),
-                    "fsName": self.model.config.get("fs-name"),
-                    "pool": self.model.config.get("pool-name"),
-                    "imageFeatures": "layering",
-                    "csi.storage.k8s.io/provisioner-secret-name": "ceph-csi-secret",
-                    "csi.storage.k8s.io/provisioner-secret-namespace": self.model.name,
-                    "csi.storage.k8s.io/controller-expand-secret-name": "ceph-csi-secret",
-                    "csi.storage.k8s.io/controller-expand-secret-namespace": self.model.name,
-                    "csi.storage.k8s.io/node-stage-secret-name": "ceph-csi-secret",
-                    "csi.storage.k8s.io/node-stage-secret-namespace": self.model.name,
-                    "csi.storage.k8s.io/fstype": self.model.config.get("fs-type"),
+        api_instance = self._get_storage_api()
+        from kubernetes.client.exceptions import ApiException
+
+        config = self.model.config
+
+        sc = {
+            "apiVersion": "storage.k8s.io/v1",
+            "kind": "StorageClass",
+            "metadata": {"name": "ceph-csi-sc"},
+            "provisioner": DRIVER_NAME,
+            "reclaimPolicy": config.get("reclaim-policy"),
+            "allowVolumeExpansion": config.get("allow-volume-expansion"),
+            "mountOptions": config.get("mount-options").split(","),
+            "parameters": {
+                "clusterID": config.get("cluster-id"),
+                "fsName": config.get("fs-name"),
+                "pool": config.get("pool-name"),
+                "imageFeatures": "layering",
+                "csi.storage.k8s.io/provisioner-secret-name": "ceph-csi-secret",
+                "csi.storage.k8s.io/provisioner-secret-namespace": self.model.name,
+                "csi.storage.k8s.io/controller-expand-secret-name": "ceph-csi-secret",
+                "csi.storage.k8s.io/controller-expand-secret-namespace": self.model.name,
+                "csi.storage.k8s.io/node-stage-secret-name": "ceph-csi-secret",
+                "csi.storage.k8s.io/node-stage-secret-namespace": self.model.name,
+                "csi.storage.k8s.io/fstype": config.get("fs-type"),
+            },
+        }
+
+        def apply():
+            # patch_storage_class cannot send an apply patch on the pinned
+            # client, so the request is made directly.  The body is passed
+            # pre-serialised; JSON is valid YAML, and the client sends string
+            # bodies as they are.
+            api_instance.api_client.call_api(
+                "/apis/storage.k8s.io/v1/storageclasses/{name}",
+                "PATCH",
+                path_params={"name": "ceph-csi-sc"},
+                query_params=[("fieldManager", "ceph-csi-operator"), ("force", True)],
+                header_params={
+                    "Accept": "application/json",
+                    "Content-Type": "application/apply-patch+yaml",
                 },
-                "metadata": {"name": "ceph-csi-sc"},
-            }
-            try:
-                api_instance.create_storage_class(sc)
-            except:
-                self.model.unit.status = MaintenanceStatus(
-                    "Failed to apply StorageClass"
-                )
-                self.remove_storage_class()
-                self.apply_storage_class()
+                body=json.dumps(sc),
+                auth_settings=["BearerToken"],
+            )
+
+        try:
+            apply()
+        except ApiException as e:
+            if e.status != 422:
+                raise
+            # The provisioner, parameters and reclaim policy of a StorageClass
+            # are immutable, so changing them means replacing it, once.
+            self.model.unit.status = MaintenanceStatus("Replacing StorageClass")
+            self.remove_storage_class()
+            apply()
 
     def remove_storage_class(self):
         """
-        Due to StorageClass not being namespaces and `create_storage_class` erroring
-        when trying to re-apply, we need to clean up the existing StorageClass on certain
-        events.
+        StorageClass parameters cannot be updated in place, so one whose
+        parameters have changed has to be deleted before it is applied again.
+        """
+        self._get_storage_api().delete_storage_class("ceph-csi-sc")
+
+    def _invalidate_caches(self, event):
+        """
+        Attaching a new resource revision triggers upgrade-charm, so forget
+        the spec rendered from the previous revision's image details.  The
+        new charm revision may also render a different pod spec from the
+        same inputs.
+        """
+        self._stored.last_spec_hash = None
+        self._stored.last_spec_digest = None
+
+    def _forget_applied_spec(self, event):
+        """
+        Another unit may have set the pod spec while this one was not the
+        leader, so a newly elected leader sets it again.
+        """
+        self._stored.last_spec_hash = None
+        self._stored.last_spec_digest = None
+
+    @staticmethod
+    def _hash_inputs(*inputs):
+        """
+        Stable fingerprint of the inputs the pod spec is rendered from.
         """
-        self._get_kubernetes_environment()
+        return hashlib.blake2b(
+            json.dumps(inputs, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
 
-        configuration = kubernetes.config.load_incluster_config()
-        with kubernetes.client.ApiClient(configuration) as api_client:
-            api_instance = kubernetes.client.StorageV1beta1Api(api_client)
-            api_instance.delete_storage_class("ceph-csi-sc")
+    def _fetch_images(self, *resources):
+        """
+        Fetch the image details of OCI image resources, one at a time since
+        ops' Model.resources is not thread-safe.  They hold the registry
+        credentials, so they are not kept in stored state; hooks whose
+        inputs are unchanged skip the fetch altogether.
+        """
+        return [resource.fetch() for resource in resources]
+
+    def _log_image_error(self, error):
+        """
+        A missing resource fails every hook until it is attached, so only log
+        an image error at ERROR level the first time it is seen.
+        """
+        message = error.status.message
+        if message == self._stored.last_image_error:
+            log.debug(message)
+            return
+        log.error(message)
+        self._stored.last_image_error = message
+
+    def _defer_once(self, event):
+        """
+        set_pod_spec works from the current model rather than from the event,
+        so a single deferred notice is enough to retry it.  Don't queue
+        another one for every hook that fires while ceph isn't ready.
+        """
+        notices = self.framework._storage.notices()
+        for event_path, observer_path, method_name in notices:
+            if event_path == event.handle.path:
+                continue
+            if observer_path == self.handle.path and method_name == "set_pod_spec":
+                return
+        event.defer()
 
     def set_pod_spec(self, event):
         """
         Setup all the compononets needed.
         """
-        if event in [
-            self.on.remove,
-            self.on.config_changed,
-            self.on["ceph"].relation_changed,
-        ]:
-            self.delete_storage_class()
+        # Only the leader may set the pod spec; the other units have nothing
+        # to do.
+        if not self.unit.is_leader():
+            self.model.unit.status = ActiveStatus()
+            return
+
+        config = self.model.config
+        metrics_port = config["metrics-port"]
 
         ceph_user = None
         ceph_key = None
         ceph_monitors = []
-        if self.model.relations.get("ceph"):
-            ceph = self.model.relations["ceph"]
-            for relation in ceph:
-                for unit in list(relation.units):
-                    ceph_user = relation.data[unit]["auth"]
-                    ceph_key = relation.data[unit]["key"]
-                    ceph_monitors.append(relation.data[unit]["ceph-public-address"])
+        for relation in self.model.relations["ceph"]:
+            for unit in relation.units:
+                data = relation.data[unit]
+                # Units that have not published their credentials yet are
+                # skipped, rather than failing the hook with a KeyError.
+                if not all(k in data for k in ("auth", "key", "ceph-public-address")):
+                    continue
+                ceph_user = data["auth"]
+                ceph_key = data["key"]
+                ceph_monitors.append(data["ceph-public-address"])
+        # Relation units come back in no particular order.
+        ceph_monitors.sort()
 
         if not ceph_user or not ceph_key:
             self.model.unit.status = MaintenanceStatus("Waiting on ceph relation")
-            event.defer()
+            self._defer_once(event)
+            return
+
+        # Image resources only change with upgrade-charm, which clears the
+        # stored hash, so unchanged inputs need no image fetch at all.
+        spec_hash = self._hash_inputs(
+            dict(config),
+            ceph_user,
+            ceph_key,
+            ceph_monitors,
+            DRIVER_NAME,
+        )
+        # A unit left in any other status by an earlier hook reconciles again.
+        if spec_hash == self._stored.last_spec_hash and isinstance(
+            self.model.unit.status, ActiveStatus
+        ):
+            return
 
         try:
-            csi_image = self.csi_image.fetch()
-            provisioner_image = self.provisioner_image.fetch()
-            resizer_image = self.resizer_image.fetch()
-            snapshotter_image = self.snapshotter_image.fetch()
-            attacher_image = self.attacher_image.fetch()
+            (
+                csi_image,
+                provisioner_image,
+                resizer_image,
+                snapshotter_image,
+                attacher_image,
+            ) = self._fetch_images(
+                self.csi_image,
+                self.provisioner_image,
+                self.resizer_image,
+                self.snapshotter_image,
+                self.attacher_image,
+            )
         except OCIImageResourceError as e:
             self.model.unit.status = e.status
-            log.error(e)
+            self._log_image_error(e)
             return
+        self._stored.last_image_error = None
 
         csi_config = [
             {
-                "clusterID": self.model.config.get("cluster-id"),
+                "clusterID": config.get("cluster-id"),
                 "monitors": ceph_monitors,
             }
         ]
 
-        csi_socket = {
-            "container": "/csi/csi.sock",
-            "host": "/var/lib/kubelet/plugins{}/csi.sock".format(self.driver_name),
+        spec = {
+            "version": 3,
+            "containers": [
+                {**PROVISIONER_CONTAINER, "imageDetails": provisioner_image},
+                {**RESIZER_CONTAINER, "imageDetails": resizer_image},
+                {**SNAPSHOTTER_CONTAINER, "imageDetails": snapshotter_image},
+                {**ATTACHER_CONTAINER, "imageDetails": attacher_image},
+                plugin_container(csi_image, "--controllerserver=true", "--pidlimit=-1"),
+                liveness_container(csi_image, metrics_port),
+            ],
         }
-
-        csi_volume = {
-            "name": "socket-dir",
-            "mountPath": os.path.dirname(str(csi_socket.get("container"))),
-            "hostPath": {
-                "path": os.path.dirname(str(csi_socket.get("host"))),
-                "type": "DirectoryOrCreate",
-            },
-        }
-
-        default_environment = {
-            "NODE_ID": {"field": {"path": "spec.nodeName", "api-version": "v1"}},
-            "POD_IP": {"field": {"path": "status.podIP", "api-version": "v1"}},
-            "CSI_ENDPOINT": "unix://{}".format(csi_socket.get("container")),
-        }
-
-        self.model.unit.status = MaintenanceStatus("Setting pod spec")
-        self.model.pod.set_spec(
-            {
-                "version": 3,
-                "containers": [
-                    {
-                        "name": "ceph-provisioner",
-                        "imageDetails": provisioner_image,
-                        "args": [
-                            "--csi-address={}".format(csi_socket.get("container")),
-                            "--v=5",
-                            "--timeout=150s",
-                            "--leader-election=true",
-                            "--retry-interval-start=500ms",
-                            "--feature-gates=Topology=false",
-                            "--extra-create-metadata=true",
-                        ],
-                        "ports": [
-                            {
-                                "name": "metrics",
-                                "containerPort": int(self.model.config["metrics-port"]),
-                            }
-                        ],
-                        "volumeConfig": [csi_volume],
-                    },
-                    {
-                        "name": "ceph-resizer",
-                        "imageDetails": resizer_image,
-                        "args": [
-                            "--csi-address={}".format(csi_socket.get("container")),
-                            "--v=5",
-                            "--timeout=150s",
-                            "--leader-election=true",
-                            "--retry-interval-start=500ms",
-                            "--handle-volume-inuse-error=false",
-                        ],
-                        "volumeConfig": [csi_volume],
-                        "envConfig": default_environment,
-                    },
+        k8s_resources = {
+            "kubernetesResources": {
+                "serviceAccounts": SERVICE_ACCOUNTS,
+                "secrets": [
                     {
-                        "name": "ceph-snapshotter",
-                        "imageDetails": snapshotter_image,
-                        "args": [
-                            "--csi-address={}".format(csi_socket.get("container")),
-                            "--v=5",
-                            "--timeout=150s",
-                            "--leader-election=true",
-                        ],
-                        "volumeConfig": [csi_volume],
-                        "kubernetes": {
-                            "securityContext": {
-                                "privileged": True,
-                            }
+                        "name": "ceph-csi-secret",
+                        "stringData": {
+                            "adminID": ceph_user,
+                            "adminKey": ceph_key,
                         },
-                    },
-                    {
-                        "name": "csi-cephfsplugin-attacher",
-                        "imageDetails": attacher_image,
-                        "args": [
-                            "--csi-address={}".format(csi_socket.get("container")),
-                            "--v=5",
-                            "--leader-election=true",
-                            "--retry-interval-start=500ms",
-                        ],
-                        "volumeConfig": [csi_volume],
-                        "envConfig": default_environment,
-                    },
-                    {
-                        "name": "csi-cephfsplugin",
-                        "imageDetails": csi_image,
-                        "args": [
-                            "--nodeid={}".format(socket.gethostname()),
-                            "--type=cephfs",
-                            "--controllerserver=true",
-                            "--endpoint=unix://{}".format(csi_socket.get("container")),
-                            "--v=5",
-                            "--drivername={}".format(self.driver_name),
-                            "--pidlimit=-1",
-                        ],
-                        "volumeConfig": [
-                            csi_volume,
-                            {
-                                "name": "mountpoint-dir",
-                                "mountPath": "/var/lib/kubelet/pods",
-                                "hostPath": {
-                                    "path": "/var/lib/kubelet/pods",
-                                    "type": "DirectoryOrCreate",
-                                },
-                            },
-                            {
-                                "name": "plugin-dir",
-                                "mountPath": "/var/lib/kubelet/plugins",
-                                "hostPath": {
-                                    "path": "/var/lib/kubelet/plugins",
-                                    "type": "Directory",
-                                },
-                            },
-                            {
-                                "name": "host-sys",
-                                "mountPath": "/sys",
-                                "hostPath": {"path": "/sys"},
-                            },
-                            {
-                                "name": "lib-modules",
-                                "mountPath": "/lib/modules",
-                                "hostPath": {"path": "/lib/modules"},
-                            },
-                            {
-                                "name": "host-dev",
-                                "mountPath": "/dev",
-                                "hostPath": {"path": "/dev"},
-                            },
-                            {
-                                "name": "host-mount",
-                                "mountPath": "/run/mount",
-                                "hostPath": {"path": "/run/mount"},
-                            },
-                            {
-                                "name": "keys-tmp-dir",
-                                "mountPath": "/tmp/csi/keys",
-                                "hostPath": {"path": "/tmp/csi/keys"},
-                            },
-                            {
-                                "name": "ceph-csi-config",
-                                "mountPath": "/etc/ceph-csi-config",
-                                "hostPath": {"path": "/etc/ceph-csi-config"},
-                            },
-                        ],
-                        "envConfig": default_environment,
-                        "kubernetes": {
-                            "securityContext": {
-                                "privileged": True,
-                            }
-                        },
-                    },
-                    {
-                        "name": "liveness-prometheus",
-                        "imageDetails": csi_image,
-                        "args": [
-                            "--type=liveness",
-                            "--endpoint=unix://{}".format(csi_socket.get("container")),
-                            "--metricsport={}".format(
-                                self.model.config.get("metrics-port")
-                            ),
-                            "--metricspath=/metrics",
-                            "--polltime=60s",
-                            "--timeout=3s",
-                        ],
-                        "volumeConfig": [
-                            {
-                                "name": "socket-dir",
-                                "mountPath": os.path.dirname(
-                                    str(csi_socket.get("container"))
-                                ),
-                                "hostPath": {
-                                    "path": os.path.dirname(
-                                        str(csi_socket.get("host"))
-                                    ),
-                                    "type": "DirectoryOrCreate",
-                                },
-                            }
-                        ],
-                        "envConfig": default_environment,
-                    },
+                    }
                 ],
             },
-            k8s_resources={
-                "kubernetesResources": {
-                    "serviceAccounts": [
-                        {
-                            "name": "cephfs-csi-provisioner",
-                            "roles": [
-                                {
-                                    "name": "cephfs-csi-provisioner-runner",
-                                    "global": True,
-                                    "rules": [
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": ["nodes"],
-                                            "verbs": ["get", "list", "watch"],
-                                        },
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": ["secrets"],
-                                            "verbs": ["get", "list"],
-                                        },
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": ["events"],
-                                            "verbs": [
-                                                "list",
-                                                "watch",
-                                                "create",
-                                                "update",
-                                                "patch",
-                                            ],
-                                        },
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": ["persistentvolumes"],
-                                            "verbs": [
-                                                "get",
-                                                "list",
-                                                "watch",
-                                                "create",
-                                                "delete",
-                                                "patch",
-                                            ],
-                                        },
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": ["persistentvolumeclaims"],
-                                            "verbs": ["get", "list", "watch", "update"],
-                                        },
-                                        {
-                                            "apiGroups": ["storage.k8s.io"],
-                                            "resources": ["storageclasses"],
-                                            "verbs": ["get", "list", "watch"],
-                                        },
-                                        {
-                                            "apiGroups": ["snapshot.storage.k8s.io"],
-                                            "resources": ["volumesnapshots"],
-                                            "verbs": ["get", "list"],
-                                        },
-                                        {
-                                            "apiGroups": ["snapshot.storage.k8s.io"],
-                                            "resources": ["volumesnapshotcontents"],
-                                            "verbs": [
-                                                "create",
-                                                "get",
-                                                "list",
-                                                "watch",
-                                                "update",
-                                                "delete",
-                                            ],
-                                        },
-                                        {
-                                            "apiGroups": ["snapshot.storage.k8s.io"],
-                                            "resources": ["volumesnapshotclasses"],
-                                            "verbs": ["get", "list", "watch"],
-                                        },
-                                        {
-                                            "apiGroups": ["storage.k8s.io"],
-                                            "resources": ["volumeattachments"],
-                                            "verbs": [
-                                                "get",
-                                                "list",
-                                                "watch",
-                                                "update",
-                                                "patch",
-                                            ],
-                                        },
-                                        {
-                                            "apiGroups": ["storage.k8s.io"],
-                                            "resources": ["volumeattachments/status"],
-                                            "verbs": ["patch"],
-                                        },
-                                        {
-                                            "apiGroups": [""],
-                                            "resources": [
-                                                "persistentvolumeclaims/status"
-                                            ],
-                                            "verbs": ["update", "patch"],
-                                        },
-                                        {
-                                            "apiGroups": ["storage.k8s.io"],
-                                            "resources": ["csinodes"],
-                                            "verbs": ["get", "list", "watch"],
-                                        },
-                                        {
-                                            "apiGroups": ["snapshot.storage.k8s.io"],
-                                            "resources": [
-                                                "volumesnapshotcontents/status"
-                                            ],
-                                            "verbs": ["update"],
-                                        },
-                                    ],
-                                }
-                            ],
-                        }
-                    ],
-                    "secrets": [
-                        {
-                            "name": "ceph-csi-secret",
-                            "stringData": {
-                                "adminID": ceph_user,
-                                "adminKey": ceph_key,
-                            },
-                        }
-                    ],
-                },
-                "configMaps": {
-                    "ceph-csi-config": {"config.json": json.dumps(csi_config)}
-                },
+            "configMaps": {
+                "ceph-csi-config": {
+                    # Compact and key-sorted, so the same config always
+                    # serialises to the same bytes.
+                    "config.json": json.dumps(
+                        csi_config, separators=(",", ":"), sort_keys=True
+                    )
+                }
             },
-        )
-        self.apply_storage_class()
+        }
+
+        try:
+            validate_pod_spec(spec)
+        except ValueError as e:
+            log.error("Invalid pod spec: %s", e)
+            self.model.unit.status = BlockedStatus(f"Invalid pod spec: {e}")
+            return
+
+        # Settings that only affect the StorageClass render the same pod
+        # spec, which juju need not be sent again.
+        spec_digest = self._hash_inputs(spec, k8s_resources)
+        if spec_digest != self._stored.last_spec_digest:
+            self.model.unit.status = MaintenanceStatus("Setting pod spec")
+            self.model.pod.set_spec(spec, k8s_resources=k8s_resources)
+            self._stored.last_spec_digest = spec_digest
+
+        from kubernetes.client.exceptions import ApiException
+        from kubernetes.config import ConfigException
+        from urllib3.exceptions import HTTPError
+
+        # On failure the fingerprint is left unset, so a later hook applies
+        # the StorageClass again.
+        try:
+            self.apply_storage_class()
+        except ConfigException as e:
+            # Missing in-cluster credentials will not turn up on a retry.
+            log.error("Failed to load in-cluster config: %s", e)
+            self.model.unit.status = BlockedStatus("Failed to load in-cluster config")
+            return
+        except HTTPError as e:
+            log.warning("Failed to reach the Kubernetes API: %s", e)
+            self.model.unit.status = WaitingStatus("Waiting on the Kubernetes API")
+            self._defer_once(event)
+            return
+        except ApiException as e:
+            # Throttling and server errors clear up on their own.  Any other
+            # error, such as a 403 for a missing RBAC rule, needs an operator.
+            if e.status == 429 or (e.status or 0) >= 500:
+                log.warning("Failed to apply StorageClass: %s", e.reason)
+                self.model.unit.status = WaitingStatus("Waiting on the Kubernetes API")
+                self._defer_once(event)
+            else:
+                log.error("Failed to apply StorageClass: %s", e.reason)
+                self.model.unit.status = BlockedStatus("Failed to apply StorageClass")
+            return
+        self._stored.last_spec_hash = spec_hash
         self.model.unit.status = ActiveStatus()
 
 
 if __name__ == "__main__":
-    main(CephCsiCharm)
\ No newline at end of file
+    main(CephCsiCharm)
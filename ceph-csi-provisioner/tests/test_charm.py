@@ -1,14 +1,59 @@
 # Copyright 2021 Joseph David Borg
 # See LICENSE file for licensing details.
 
+import json
+import os
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs, urlsplit
 
+from kubernetes.client import ApiClient, Configuration, StorageV1Api
+from kubernetes.client.exceptions import ApiException
+from kubernetes.config import ConfigException
+from ops.model import BlockedStatus, WaitingStatus
 from ops.testing import Harness
+from urllib3.exceptions import MaxRetryError
 from charm import CephCsiCharm
 
 
 class TestCharm(unittest.TestCase):
+    def _harness_with_ceph(self, *incomplete_units):
+        """
+        A started leader harness related to ceph-mon/0, which has published
+        its credentials, and to any `incomplete_units`, which have not.
+        """
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.populate_oci_resources()
+        relation_id = harness.add_relation("ceph", "ceph-mon")
+        harness.add_relation_unit(relation_id, "ceph-mon/0")
+        for unit in incomplete_units:
+            harness.add_relation_unit(relation_id, unit)
+        harness.update_relation_data(
+            relation_id,
+            "ceph-mon/0",
+            {"auth": "admin", "key": "secret", "ceph-public-address": "10.0.0.1"},
+        )
+        harness.begin()
+        return harness
+
+    def _storage_api(self, *statuses):
+        """
+        A real StorageV1Api whose HTTP requests are answered with `statuses`
+        in turn, and the mock recording what the client would have sent.
+        """
+        api = StorageV1Api(ApiClient(Configuration()))
+        data = json.dumps({"provisioner": "cephfs.csi.ceph.com"}).encode()
+        patcher = patch.object(
+            api.api_client.rest_client.pool_manager,
+            "request",
+            side_effect=[Mock(status=s, reason="", data=data) for s in statuses],
+        )
+        request = patcher.start()
+        self.addCleanup(patcher.stop)
+        return api, request
+
     def test_config_changed(self):
         harness = Harness(CephCsiCharm)
         self.addCleanup(harness.cleanup)
@@ -33,3 +78,171 @@ class TestCharm(unittest.TestCase):
         harness.charm._on_fortune_action(action_event)
 
         self.assertEqual(action_event.fail.call_args, [("fail this",)])
+
+    def test_registry_credentials_not_stored(self):
+        harness = self._harness_with_ceph()
+        with patch.object(CephCsiCharm, "apply_storage_class"):
+            harness.charm.set_pod_spec(Mock())
+        self.assertIsNotNone(harness.get_pod_spec())
+        stored = json.dumps(harness.charm._stored._data.snapshot())
+        self.assertNotIn("password", stored)
+
+    @patch.object(CephCsiCharm, "_get_kubernetes_environment")
+    @patch("kubernetes.config.load_incluster_config")
+    def test_storage_api_reused(self, load_incluster_config, _):
+        self.addCleanup(setattr, CephCsiCharm, "_storage_api", None)
+        api = CephCsiCharm._get_storage_api()
+        self.assertIs(CephCsiCharm._get_storage_api(), api)
+        load_incluster_config.assert_called_once()
+
+    def test_immutable_storage_class_replaced_once(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        api, request = self._storage_api(422, 200, 200)
+        with patch.object(CephCsiCharm, "_get_storage_api", return_value=api):
+            harness.charm.apply_storage_class()
+        methods = [args[0] for args, _ in request.call_args_list]
+        self.assertEqual(methods, ["PATCH", "DELETE", "PATCH"])
+
+    def test_storage_class_error_not_retried(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        api, request = self._storage_api(500)
+        with patch.object(CephCsiCharm, "_get_storage_api", return_value=api):
+            self.assertRaises(ApiException, harness.charm.apply_storage_class)
+        request.assert_called_once()
+
+    @patch.dict("os.environ", {}, clear=True)
+    @patch("charm.Path.read_text")
+    def test_kubernetes_environment(self, read_text):
+        read_text.return_value = "\x00".join(
+            [
+                "KUBERNETES_SERVICE_HOST=10.152.183.1",
+                "KUBERNETES_SERVICE_PORT=443",
+                "JUJU_ARGS=--opt=KUBERNETES_SERVICE",
+            ]
+        )
+        CephCsiCharm._get_kubernetes_environment()
+        self.assertEqual(
+            dict(os.environ),
+            {
+                "KUBERNETES_SERVICE_HOST": "10.152.183.1",
+                "KUBERNETES_SERVICE_PORT": "443",
+            },
+        )
+
+    def test_incomplete_ceph_units_skipped(self):
+        harness = self._harness_with_ceph("ceph-mon/1")
+        with patch.object(CephCsiCharm, "apply_storage_class"):
+            harness.charm.set_pod_spec(Mock())
+        _, k8s_resources = harness.get_pod_spec()
+        self.assertEqual(
+            k8s_resources["configMaps"]["ceph-csi-config"]["config.json"],
+            '[{"clusterID":"","monitors":["10.0.0.1"]}]',
+        )
+
+    def test_waiting_on_ceph_deferred_once(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        harness.update_config({"metrics-port": 9000})
+        harness.update_config({"metrics-port": 9001})
+        notices = list(harness.framework._storage.notices())
+        self.assertEqual(len(notices), 1)
+        self.assertEqual(notices[0][2], "set_pod_spec")
+        self.assertEqual(harness.charm.unit.status.message, "Waiting on ceph relation")
+
+    def test_storage_class_server_side_applied(self):
+        harness = Harness(CephCsiCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        api, request = self._storage_api(200)
+        with patch.object(CephCsiCharm, "_get_storage_api", return_value=api):
+            harness.charm.apply_storage_class()
+        (method, url), kwargs = request.call_args
+        self.assertEqual(method, "PATCH")
+        url = urlsplit(url)
+        self.assertEqual(url.path, "/apis/storage.k8s.io/v1/storageclasses/ceph-csi-sc")
+        self.assertEqual(
+            parse_qs(url.query),
+            {"fieldManager": ["ceph-csi-operator"], "force": ["True"]},
+        )
+        self.assertEqual(
+            kwargs["headers"]["Content-Type"], "application/apply-patch+yaml"
+        )
+        self.assertEqual(json.loads(kwargs["body"])["kind"], "StorageClass")
+
+    def test_storage_class_only_change_keeps_pod_spec(self):
+        harness = self._harness_with_ceph()
+        with patch.object(CephCsiCharm, "apply_storage_class") as apply_sc:
+            harness.charm.set_pod_spec(Mock())
+            with patch.object(harness.charm.model.pod, "set_spec") as set_spec:
+                harness.update_config({"reclaim-policy": "Retain"})
+                set_spec.assert_not_called()
+            self.assertEqual(apply_sc.call_count, 2)
+
+    def test_storage_class_failure_deferred(self):
+        harness = self._harness_with_ceph()
+        with patch.object(
+            CephCsiCharm, "apply_storage_class", side_effect=ApiException(status=500)
+        ):
+            harness.update_config({"reclaim-policy": "Retain"})
+        self.assertIsInstance(harness.charm.unit.status, WaitingStatus)
+        self.assertIsNone(harness.charm._stored.last_spec_hash)
+        notices = list(harness.framework._storage.notices())
+        self.assertEqual(len(notices), 1)
+
+    def test_unreachable_apiserver_deferred(self):
+        harness = self._harness_with_ceph()
+        with patch.object(
+            CephCsiCharm,
+            "apply_storage_class",
+            side_effect=MaxRetryError(None, "/apis/storage.k8s.io/v1"),
+        ):
+            harness.update_config({"reclaim-policy": "Retain"})
+        self.assertIsInstance(harness.charm.unit.status, WaitingStatus)
+        notices = list(harness.framework._storage.notices())
+        self.assertEqual(len(notices), 1)
+
+    def test_storage_class_rejected_blocks(self):
+        harness = self._harness_with_ceph()
+        with patch.object(
+            CephCsiCharm, "apply_storage_class", side_effect=ApiException(status=403)
+        ):
+            harness.update_config({"reclaim-policy": "Retain"})
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+        self.assertIsNone(harness.charm._stored.last_spec_hash)
+        self.assertEqual(list(harness.framework._storage.notices()), [])
+
+    def test_missing_incluster_config_blocks(self):
+        harness = self._harness_with_ceph()
+        with patch.object(
+            CephCsiCharm,
+            "apply_storage_class",
+            side_effect=ConfigException("Service token file does not exist."),
+        ):
+            harness.update_config({"reclaim-policy": "Retain"})
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+        self.assertEqual(list(harness.framework._storage.notices()), [])
+
+    def test_container_args_well_formed(self):
+        harness = self._harness_with_ceph()
+        with patch.object(CephCsiCharm, "apply_storage_class"):
+            harness.charm.set_pod_spec(Mock())
+        spec, _ = harness.get_pod_spec()
+        for container in spec["containers"]:
+            flags = [arg.partition("=")[0] for arg in container["args"]]
+            for flag in flags:
+                self.assertRegex(flag, r"^--[a-z]+(-[a-z]+)*$")
+            self.assertEqual(len(flags), len(set(flags)), container["name"])
+
+    def test_invalid_pod_spec_blocks(self):
+        harness = self._harness_with_ceph()
+        with patch.object(CephCsiCharm, "apply_storage_class") as apply_sc:
+            harness.update_config({"metrics-port": 0})
+            apply_sc.assert_not_called()
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+        self.assertIsNone(harness.get_pod_spec())